@@ -6,9 +6,13 @@ Claudius Korzen <korzen@cs.uni-freiburg.de>
 Patrick Brosi <brosi@cs.uni-freiburg.de>
 """
 
+import csv
 import readline  # NOQA
 import sys
 from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
 
 # Uncomment to use C version of prefix edit distance calculation.
 # You have to install the module using the provided ped_c/setup.py
@@ -18,6 +22,53 @@ from ped_c import ped
 # Comment to use C version of prefix edit distance calculation
 #from ped_python import ped
 
+# C version of the normalization and q-gram computation. You have to
+# install the module using the provided qgrams_c/setup.py first, otherwise
+# the Python version is used.
+try:
+    from qgrams_c import normalize_and_qgrams as normalize_and_qgrams_c
+    from qgrams_c import MAX_Q as MAX_Q_C
+except ImportError:
+    normalize_and_qgrams_c = None
+    MAX_Q_C = 0
+
+# Q-grams are encoded as ints by packing the code points of their
+# characters, CHAR_BITS bits each (enough for all of Unicode).
+CHAR_BITS = 21
+CHAR_MASK = (1 << CHAR_BITS) - 1
+
+
+class AlnumTable(dict):
+    """
+    A translation table for str.translate that keeps alphanumeric
+    characters and removes all others. The entries are computed when a
+    character is first seen.
+    """
+
+    def __missing__(self, code):
+        value = code if chr(code).isalnum() else None
+        self[code] = value
+        return value
+
+
+ALNUM_TABLE = AlnumTable()
+
+
+def ped_fast(x, y, delta):
+    '''
+    Computes the prefix edit distance PED(x, y) for the given delta, like
+    ped, but without the dynamic program for delta 0: then PED(x, y) is 0
+    exactly if y starts with x, and delta + 1 otherwise.
+
+    >>> ped_fast("frei", "freiburg", 0)
+    0
+    >>> ped_fast("frei", "brei", 0)
+    1
+    '''
+    if delta == 0:
+        return 0 if y.startswith(x) else 1
+    return ped(x, y, delta)
+
 
 class QGramIndex:
     """
@@ -31,8 +82,41 @@ class QGramIndex:
 
         self.q = q
         self.inverted_lists = defaultdict(list)  # The inverted lists.
+        # The inverted lists frozen after building: all lists concatenated
+        # into one array of entity IDs and one of frequencies, and the
+        # (start, end) offsets of the list of each q-gram.
+        self.offsets = {}
+        self.ids = np.empty(0, dtype=np.int32)
+        self.freqs = np.empty(0, dtype=np.uint8)
         self.padding = "$" * (q - 1)
-        self.entities = {}
+        # For computing the int-encoded q-grams with a rolling code.
+        self._padding_code = self.encode_qgram(self.padding)
+        self._qgram_mask = (1 << (CHAR_BITS * q)) - 1
+        # The C version packs the q-grams into 64-bit ints.
+        self._normalize_and_qgrams_c = \
+                normalize_and_qgrams_c if q <= MAX_Q_C else None
+        # The entities, one array per attribute, indexed by entity ID
+        # (index 0 is unused). The scores and the lengths of the normalized
+        # names are int32 arrays.
+        self.names = [None]
+        self.n_names = [""]
+        self.n_name_lens = np.zeros(1, dtype=np.int32)
+        # The code point of the first character of each normalized name and
+        # the char_mask of its first two characters, for cheap tests before
+        # computing PED.
+        self.first_chars = np.zeros(1, dtype=np.int32)
+        self.first2_masks = np.zeros(1, dtype=np.uint64)
+        self.scores = np.zeros(1, dtype=np.int32)
+        self.descs = [None]
+        self.urls = [None]
+        self.wiki_ids = [None]
+        self.synonyms = [None]
+        self.img_urls = [None]
+        # Memoized PED computations, keyed on (prefix, name, delta), and
+        # memoized results of find_matches, keyed on (prefix, delta, k).
+        # Search-as-you-type reissues the same queries over and over.
+        self._ped = lru_cache(maxsize=200000)(ped)
+        self._cached_matches = lru_cache(maxsize=1024)(self._find_matches)
 
     def build_from_file(self, file_name):
         '''
@@ -40,51 +124,158 @@ class QGramIndex:
 
         The entity IDs are one-based (starting with one).
 
-        The test expects the index to store tuples (<entity id>, <frequency>),
-        for each q-gram, where <entity id> is the ID of the entity the
-        q-gram appears in, and <frequency> is the number of times it appears
-        in the entity.
+        The index is first built as tuples (<entity id>, <frequency>),
+        for each q-gram (encoded as an int, see encode_qgram), where
+        <entity id> is the ID of the entity the q-gram appears in, and
+        <frequency> is the number of times it appears in the entity.
+        Afterwards, the inverted lists are frozen into flat arrays, see
+        freeze_lists.
 
         For example, the 3-gram "rei" appears 1 time in entity 1 ("frei") and
         one time in entity 2 ("brei"), so its inverted list is
-        [(1, 1), (2, 1)].
+        [1, 2] with frequencies [1, 1].
 
         >>> qi = QGramIndex(3)
         >>> qi.build_from_file("test.tsv")
-        >>> sorted(qi.inverted_lists.items())
+        >>> sorted((qi.decode_qgram(g), qi.ids[a:b].tolist(),
+        ...         qi.freqs[a:b].tolist()) for g, (a, b) in qi.offsets.items())
         ... # doctest: +NORMALIZE_WHITESPACE
-        [('$$b', [(2, 1)]), ('$$f', [(1, 1)]), ('$br', [(2, 1)]),
-         ('$fr', [(1, 1)]), ('bre', [(2, 1)]), ('fre', [(1, 1)]),
-         ('rei', [(1, 1), (2, 1)])]
+        [('$$b', [2], [1]), ('$$f', [1], [1]), ('$br', [2], [1]),
+         ('$fr', [1], [1]), ('bre', [2], [1]), ('fre', [1], [1]),
+         ('rei', [1, 2], [1, 1])]
+        >>> qi.n_names[1:], qi.scores[1:].tolist()
+        (['frei', 'brei'], [3, 2])
+
+        Building again replaces the entities of the previous build.
+
+        >>> qi.build_from_file("test.tsv")
+        >>> len(qi.n_names), len(qi.scores)
+        (3, 3)
+        >>> qi.find_matches("frei", 2)
+        [(1, 0, 3), (2, 1, 2)]
         '''
+        # The cached results and the entities refer to the old index.
+        self._ped.cache_clear()
+        self._cached_matches.cache_clear()
+        self.names = [None]
+        self.n_names = [""]
+        self.descs = [None]
+        self.urls = [None]
+        self.wiki_ids = [None]
+        self.synonyms = [None]
+        self.img_urls = [None]
+
         # Code from lecture 5
-        with open(file_name, "r") as file:
-            next(file) # skip header
+        with open(file_name, "r", newline="") as file:
+            # The tokenizer of the csv module runs in C.
+            rows = csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE)
+            next(rows) # skip header
             entity_id = 0
-            for line in file:
-                if not line.strip():
+            scores = [0]
+            for row in rows:
+                if not "".join(row).strip():
                     continue
                 entity_name, score, description, wiki_url, wiki_ID,\
-                        synonyms, image_url = line.split("\t", 7)
+                        synonyms, image_url = row
                 entity_id += 1
-                self.entities[entity_id] = {
-                        "name": entity_name,
-                        "n_name": self.normalize(entity_name),
-                        "score": score,
-                        "desc": description,
-                        "url": wiki_url,
-                        "ID": wiki_ID,
-                        "syn": synonyms.strip().split(';'),
-                        "img": image_url
-                        }
-                for qgram in self.compute_qgrams(self.normalize(entity_name)):
-                    if not self.inverted_lists[qgram] or entity_id != self.inverted_lists[qgram][-1][0]:
-                        # If qgram is seen for the first time for a certain term, create new list.
-                        self.inverted_lists[qgram].append((entity_id, 1))
-                    else:
-                        t, c = self.inverted_lists[qgram][-1]
-                        c += 1
-                        self.inverted_lists[qgram][-1] = t, c
+                n_name, qgrams = self.normalize_and_qgrams(entity_name)
+                self.names.append(entity_name)
+                self.n_names.append(n_name)
+                scores.append(int(score))
+                self.descs.append(description)
+                self.urls.append(wiki_url)
+                self.wiki_ids.append(wiki_ID)
+                self.synonyms.append(synonyms.strip().split(';'))
+                self.img_urls.append(image_url)
+                # Count the q-grams of the entity first, so that each inverted
+                # list gets exactly one tuple per entity.
+                counts = {}
+                for qgram in qgrams:
+                    counts[qgram] = counts.get(qgram, 0) + 1
+                for qgram, c in counts.items():
+                    self.inverted_lists[qgram].append((entity_id, c))
+        self.scores = np.array(scores, dtype=np.int32)
+        self.n_name_lens = np.fromiter((len(n) for n in self.n_names),
+                                       dtype=np.int32, count=len(self.n_names))
+        self.first_chars = np.fromiter((ord(n[0]) if n else 0
+                                        for n in self.n_names),
+                                       dtype=np.int32, count=len(self.n_names))
+        self.first2_masks = np.fromiter((self.char_mask(n[:2])
+                                         for n in self.n_names),
+                                        dtype=np.uint64, count=len(self.n_names))
+        self.freeze_lists()
+
+    def get_entity(self, entity_id):
+        '''
+        Returns all attributes of the entity with the given ID as a dict.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.build_from_file("test.tsv")
+        >>> e = qi.get_entity(2)
+        >>> e["n_name"], e["score"]
+        ('brei', 2)
+        '''
+        return {
+                "name": self.names[entity_id],
+                "n_name": self.n_names[entity_id],
+                "score": int(self.scores[entity_id]),
+                "desc": self.descs[entity_id],
+                "url": self.urls[entity_id],
+                "ID": self.wiki_ids[entity_id],
+                "syn": self.synonyms[entity_id],
+                "img": self.img_urls[entity_id]
+                }
+
+    def freeze_lists(self):
+        '''
+        Converts the inverted lists of tuples into two flat arrays, the
+        entity IDs (int32) and the frequencies (uint8, capped at 255) of all
+        lists one after the other, and drops the tuples. The list of a
+        q-gram is at self.offsets[qgram] = (start, end) in both arrays.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.inverted_lists[7] = [(1, 1), (2, 3)]
+        >>> qi.inverted_lists[8] = [(2, 300)]
+        >>> qi.freeze_lists()
+        >>> qi.offsets
+        {7: (0, 2), 8: (2, 3)}
+        >>> qi.ids.tolist(), qi.freqs.tolist()
+        ([1, 2, 2], [1, 3, 255])
+        >>> len(qi.inverted_lists)
+        0
+        '''
+        lists = self.inverted_lists.values()
+        n = sum(len(postings) for postings in lists)
+        self.ids = np.fromiter(
+                (tID for postings in lists for tID, _ in postings),
+                dtype=np.int32, count=n)
+        self.freqs = np.fromiter(
+                (min(c, 255) for postings in lists for _, c in postings),
+                dtype=np.uint8, count=n)
+        self.offsets = {}
+        start = 0
+        for qgram, postings in self.inverted_lists.items():
+            self.offsets[qgram] = (start, start + len(postings))
+            start += len(postings)
+        self.inverted_lists.clear()
+
+    def char_mask(self, chars):
+        '''
+        Returns a 64-bit mask of the given characters, with bit
+        (code point mod 64) set for each character. Two strings without a
+        common bit have no character in common.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.char_mask("ab") == (1 << 33) | (1 << 34)
+        True
+        >>> qi.char_mask("")
+        0
+        '''
+        mask = 0
+        for c in chars:
+            mask |= 1 << (ord(c) & 63)
+        return mask
+
     def normalize(self, word):
         '''
         Normalize the given string (remove non-word characters and lower case).
@@ -94,56 +285,125 @@ class QGramIndex:
         'freiburg'
         >>> qi.normalize("Frei, burG !?!")
         'freiburg'
+        >>> qi.normalize("Baden-Württemberg")
+        'badenwürttemberg'
         '''
 
-        low = word.lower()
-        return ''.join([i for i in low if i.isalnum()])
+        return word.lower().translate(ALNUM_TABLE)
 
     def compute_qgrams(self, word):
         '''
-        Compute q-grams for padded version of given string,
+        Compute q-grams for padded version of given (normalized) string,
         since the qgrams are used for computing prefix edit distance,
-        only left paddings are added.
+        only left paddings are added. The q-grams are encoded as ints,
+        see encode_qgram, and computed with a rolling code: each character
+        shifts the previous code and is added at the low end.
 
         >>> qi = QGramIndex(3)
-        >>> qi.compute_qgrams("freiburg")
+        >>> [qi.decode_qgram(g) for g in qi.compute_qgrams("freiburg")]
         ['$$f', '$fr', 'fre', 'rei', 'eib', 'ibu', 'bur', 'urg']
         '''
-        w = self.padding + self.normalize(word)
-        return [w[i: i+self.q] for i in range(len(w) - self.q + 1)]
+        mask = self._qgram_mask
+        code = self._padding_code
+        qgrams = []
+        for c in word:
+            code = ((code << CHAR_BITS) | ord(c)) & mask
+            qgrams.append(code)
+        return qgrams
+
+    def encode_qgram(self, qgram):
+        '''
+        Encode the given q-gram as an int by packing the code points of its
+        characters.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.encode_qgram("$fr") == (36 << 42) | (102 << 21) | 114
+        True
+        '''
+        code = 0
+        for c in qgram:
+            code = (code << CHAR_BITS) | ord(c)
+        return code
+
+    def decode_qgram(self, code):
+        '''
+        Decode a q-gram encoded by encode_qgram.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.decode_qgram(qi.encode_qgram("$fr"))
+        '$fr'
+        '''
+        chars = []
+        for _ in range(self.q):
+            chars.append(chr(code & CHAR_MASK))
+            code >>= CHAR_BITS
+        return ''.join(reversed(chars))
 
-    def merge_lists(self, lists):
+    def normalize_and_qgrams(self, word):
         '''
-        Merges the given inverted lists. The tests assume that the
-        inverted lists keep count of the entity ID in the list,
-        for example, in the first test below, entity 3 appears
-        1 time in the first list, and 2 times in the second list.
-        After the merge, it occurs 3 times in the merged list.
+        Normalize the given string and compute the q-grams of the normalized
+        string in one go. Uses the C version if it is installed.
 
         >>> qi = QGramIndex(3)
-        >>> qi.merge_lists([[(1, 2), (3, 1), (5, 1)],
-        ...                 [(2, 1), (3, 2), (9, 2)]])
-        [(1, 2), (2, 1), (3, 3), (5, 1), (9, 2)]
-        >>> qi.merge_lists([[(1, 2), (3, 1), (5, 1)], []])
-        [(1, 2), (3, 1), (5, 1)]
-        >>> qi.merge_lists([[], []])
-        []
-        >>> qi.merge_lists([[(1, 1)], [(1, 1)], [(1, 1), (2, 1)]])
-        [(1, 3), (2, 1)]
-        '''
-        tmp = []
-        result = defaultdict(int)
-        for l in lists:
-            tmp += l
-        for tID, frequency in tmp:
-            result[tID] += frequency
-        return sorted(result.items())
-
-    def find_matches(self, prefix, delta):
+        >>> n_word, qgrams = qi.normalize_and_qgrams("Frei, burG !?!")
+        >>> n_word, [qi.decode_qgram(g) for g in qgrams]
+        ('freiburg', ['$$f', '$fr', 'fre', 'rei', 'eib', 'ibu', 'bur', 'urg'])
+        '''
+        if self._normalize_and_qgrams_c is not None:
+            return self._normalize_and_qgrams_c(word, self.q)
+        n_word = self.normalize(word)
+        return n_word, self.compute_qgrams(n_word)
+
+    def merge_lists(self, qgrams):
+        '''
+        Merges the inverted lists of the given q-grams and returns the
+        merged list as two arrays (entity IDs, frequencies). The tests
+        assume that the inverted lists keep count of the entity ID in the
+        list, for example, in the first test below, entity 1 appears
+        1 time in the list of "rei", 1 time in the list of "fre", and again
+        1 time in the second list of "rei". After the merge, it occurs 3 times
+        in the merged list.
+
+        >>> qi = QGramIndex(3)
+        >>> qi.build_from_file("test.tsv")
+        >>> encode = qi.encode_qgram
+        >>> ids, freqs = qi.merge_lists([encode(g) for g in ["rei", "fre", "rei"]])
+        >>> ids.tolist(), freqs.tolist()
+        ([1, 2], [3, 2])
+        >>> ids, freqs = qi.merge_lists([encode("$$b"), encode("xyz")])
+        >>> ids.tolist(), freqs.tolist()
+        ([2], [1])
+        >>> ids, freqs = qi.merge_lists([])
+        >>> ids.tolist(), freqs.tolist()
+        ([], [])
+        '''
+        offsets = [self.offsets[g] for g in qgrams if g in self.offsets]
+        if not offsets:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        ids = np.concatenate([self.ids[a:b] for a, b in offsets])
+        freqs = np.concatenate([self.freqs[a:b] for a, b in offsets])
+        freqs = freqs.astype(np.int32)
+
+        # The lists are sorted by entity ID, so a stable sort only has to
+        # merge the sorted runs.
+        order = np.argsort(ids, kind="mergesort")
+        ids = ids[order]
+        freqs = freqs[order]
+
+        # Sum up the frequencies of each run of equal entity IDs.
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        return ids[starts], np.add.reduceat(freqs, starts)
+
+    def find_matches(self, prefix, delta, k=None):
         '''
         Finds all entities y with PED(x, y) <= delta for a given integer delta
         and a given (normalized) prefix x.
 
+        If k is given, only the top k matches (see rank_matches) are
+        guaranteed to be found: the candidates are verified in order of
+        decreasing score, and the search stops as soon as k matches with
+        PED 0 have been found, since no other candidate can rank higher.
+
         The test checks for a list of triples containing the entity ID,
         the PED distance and its score:
 
@@ -159,19 +419,60 @@ class QGramIndex:
         [(1, 0, 3), (2, 1, 2)]
         >>> qi.find_matches("freibu", 2)
         [(1, 2, 3)]
+        >>> qi.find_matches("frei", 2, k=1)
+        [(1, 0, 3)]
+        '''
+        return list(self._cached_matches(prefix, delta, k))
+
+    def _find_matches(self, prefix, delta, k):
+        '''
+        Uncached version of find_matches.
         '''
         # 1. Fetch inverted lists of all q-grams generated by the input prefix
         q_grams = self.compute_qgrams(prefix)
 
         # 2. Merge all lists
-        l = self.merge_lists(self.inverted_lists[g] for g in q_grams)
+        ids, freqs = self.merge_lists(q_grams)
 
         # 3. Exclude terms that does not have enough q-grams in common with input prefix
-        l = list(filter(lambda x: x[1] >= len(prefix)-self.q*delta, l))
-
-        # 4. Compute prefix edit distance between the input prefix and remaning terms
-        return [(tID, ped(prefix, self.entities[tID]["n_name"], delta), int(self.entities[tID]["score"]))
-                for tID, _ in l if ped(prefix, self.entities[tID]["n_name"], delta) <= delta]
+        cand_ids = ids[freqs >= len(prefix) - self.q * delta]
+
+        # 3b. Exclude terms that are too short, PED(x, y) >= |x| - |y|
+        cand_ids = cand_ids[self.n_name_lens[cand_ids] >= len(prefix) - delta]
+
+        # 3c. Exclude terms by their first characters: without errors, the
+        #     first characters of x and y are equal, and with one error, the
+        #     first two characters of x and y have at least one in common.
+        if delta == 0 and prefix:
+            cand_ids = cand_ids[self.first_chars[cand_ids] == ord(prefix[0])]
+        elif delta == 1 and len(prefix) >= 2:
+            mask = np.uint64(self.char_mask(prefix[:2]))
+            cand_ids = cand_ids[(self.first2_masks[cand_ids] & mask) != 0]
+
+        # 4. Compute prefix edit distance between the input prefix and remaning terms,
+        #    each candidate is verified exactly once. For the top k, verify the
+        #    most popular candidates first (stable, so ties keep ID order).
+        if k is not None:
+            order = np.argsort(-self.scores[cand_ids], kind="stable")
+            cand_ids = cand_ids[order]
+        n_names = self.n_names
+        # With delta 0, ped_fast is a plain prefix comparison, cheaper than
+        # a lookup in the cache.
+        compute_ped = ped_fast if delta == 0 else self._ped
+        match_ids = []
+        peds = []
+        num_exact = 0
+        for tID in cand_ids.tolist():
+            d = compute_ped(prefix, n_names[tID], delta)
+            if d <= delta:
+                match_ids.append(tID)
+                peds.append(d)
+                if d == 0:
+                    num_exact += 1
+                    if num_exact == k:
+                        break
+        scores = self.scores[match_ids].tolist()
+        return list(zip(match_ids, peds, scores))
 
     def rank_matches(self, matches):
         '''
@@ -208,5 +509,5 @@ if __name__ == "__main__":
         print("-" * 50)
         print(f"Results ({min(5, len(results))}/{len(results)}):")
         for i in range(min(5, len(results))):
-            print(f'{i+1}. '+qi.entities[results[i][0]]['name']+'; '+qi.entities[results[i][0]]['desc']+'; '+qi.entities[results[i][0]]['url'])
+            print(f'{i+1}. '+qi.names[results[i][0]]+'; '+qi.descs[results[i][0]]+'; '+qi.urls[results[i][0]])
         print("*" * 50)
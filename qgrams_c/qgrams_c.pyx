@@ -0,0 +1,59 @@
+# cython: language_level=3
+"""
+C version of the normalization and q-gram computation of QGramIndex.
+"""
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+# Q-grams are encoded as ints by packing the code points of their
+# characters, CHAR_BITS bits each, see QGramIndex.encode_qgram.
+cdef enum:
+    CHAR_BITS = 21
+MAX_Q = 64 // CHAR_BITS
+
+cdef extern from "Python.h":
+    int PyUnicode_4BYTE_KIND
+    str PyUnicode_FromKindAndData(int kind, const void *buffer, Py_ssize_t size)
+
+
+def normalize_and_qgrams(str word, int q):
+    '''
+    Normalizes the given string (remove non-word characters and lower case)
+    and computes the q-grams of its left-padded version in one pass, with
+    a rolling code (each character shifts the previous code).
+
+    Returns the normalized string and the list of int-encoded q-grams.
+
+    >>> n_word, qgrams = normalize_and_qgrams("Frei, burG !?!", 3)
+    >>> n_word, qgrams[:2] == [(36 << 42) | (36 << 21) | 102,
+    ...                        (36 << 42) | (102 << 21) | 114]
+    ('freiburg', True)
+    >>> len(qgrams)
+    8
+    '''
+    if q > MAX_Q:
+        raise ValueError("q-grams longer than %d do not fit into 64 bits"
+                         % MAX_Q)
+    cdef str low = word.lower()
+    cdef Py_ssize_t n = 0
+    cdef Py_ssize_t i
+    cdef unsigned long long mask = (1ULL << (CHAR_BITS * q)) - 1
+    cdef unsigned long long code = 0
+    cdef list qgrams = []
+    cdef Py_UCS4 c
+    cdef Py_UCS4 *buf = <Py_UCS4 *> PyMem_Malloc(len(low) * sizeof(Py_UCS4))
+    if buf == NULL and len(low) > 0:
+        raise MemoryError()
+    try:
+        for i in range(q - 1):
+            code = (code << CHAR_BITS) | <unsigned long long> u'$'
+        for c in low:
+            if c.isalnum():
+                buf[n] = c
+                n += 1
+                code = ((code << CHAR_BITS) | <unsigned long long> c) & mask
+                qgrams.append(code)
+        n_word = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, buf, n)
+    finally:
+        PyMem_Free(buf)
+    return n_word, qgrams
@@ -0,0 +1,7 @@
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="qgrams_c",
+    ext_modules=cythonize("qgrams_c.pyx"),
+)
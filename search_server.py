@@ -6,6 +6,8 @@ Author: Hannah Bast <bast@cs.uni-freiburg.de>
 
 import socket
 import sys
+import threading
+from collections import OrderedDict
 from qgram_index import *
 import time
 import json
@@ -20,6 +22,15 @@ class SearchServer:
         """ Initialize with given port. """
         self.port = port
         self.se = self.build_search_engine(file)
+        # The JSON encoding of each entity, indexed by entity ID (index 0 is
+        # unused). Entities do not change after building.
+        self.entity_json = [b"{}"] + [
+                json.dumps(self.se.get_entity(entity_id)).encode('utf-8')
+                for entity_id in range(1, len(self.se.names))]
+        # LRU cache of JSON responses, keyed on (normalized query, max results).
+        self.query_cache = OrderedDict()
+        self.query_cache_size = 4096
+        self.query_cache_lock = threading.Lock()
 
     def build_search_engine(self, file_name):
         """
@@ -42,14 +53,23 @@ class SearchServer:
         while 1:
             try:
                 data = connection_socket.recv(num_bytes)
-                request_bytes.extend(data)
             except socket.timeout:
                 print("Client timeout")
                 break
+            if not data:
+                break
             # TODO: validate
-            if request_bytes[-2*len(data):].find(b'\r\n\r\n') >= 0:
+            # Only search the new data (and the 3 bytes before it, in case
+            # the '\r\n\r\n' is split across two rounds).
+            start = max(0, len(request_bytes) - 3)
+            request_bytes.extend(data)
+            if request_bytes.find(b'\r\n\r\n', start) >= 0:
                 break
-        request = request_bytes.decode('utf-8').split('\r\n')[0]
+        # Only decode the request line.
+        end = request_bytes.find(b'\r\n')
+        if end < 0:
+            end = len(request_bytes)
+        request = request_bytes[:end].decode('utf-8')
         print("Request data from client: %s" % request,"\n")
         return request
 
@@ -64,18 +84,51 @@ class SearchServer:
             Top `max_results` results.
         """
         q = self.se.normalize(query)
-        raw_results = self.se.rank_matches(self.se.find_matches(q, len(q)//4))
+        raw_results = self.se.rank_matches(
+                self.se.find_matches(q, len(q)//4, max_results))
         results = []
         for i in range(min(max_results, len(raw_results))):
-            results.append(self.se.entities[raw_results[i][0]])
+            results.append(self.se.get_entity(raw_results[i][0]))
         return results
 #            print(f'{i+1}. '+self.se.entities[results[i][0]]['name']+'; '+\
 #                    self.se.entities[results[i][0]]['desc']+'; '\
 #                    +self.se.entities[results[i][0]]['url'])
 
+    def answer_query_json(self, query, max_results=5):
+        """
+        Answer query with the qgram index, as JSON-encoded bytes. The
+        response is assembled from the precomputed JSON of the entities, and
+        cached, so repeated queries skip both the search and the encoding.
+
+        Params:
+            query(str): Query string.
+            max_results(int): Maximum number of returning search results.
+        Returns:
+            Top `max_results` results as JSON-encoded bytes.
+        """
+        q = self.se.normalize(query)
+        key = (q, max_results)
+        with self.query_cache_lock:
+            response_bytes = self.query_cache.get(key)
+            if response_bytes is not None:
+                self.query_cache.move_to_end(key)
+                return response_bytes
+        raw_results = self.se.rank_matches(
+                self.se.find_matches(q, len(q)//4, max_results))
+        response_bytes = b"[" + b", ".join(
+                self.entity_json[tID]
+                for tID, _, _ in raw_results[:max_results]) + b"]"
+        with self.query_cache_lock:
+            self.query_cache[key] = response_bytes
+            self.query_cache.move_to_end(key)
+            if len(self.query_cache) > self.query_cache_size:
+                self.query_cache.popitem(last=False)
+        return response_bytes
+
     def run(self):
         """
-        Start server and respond to clients
+        Start server and respond to clients, each client is served in its
+        own thread.
         """
         # Create server socket using IPv4 addresses and TCP, allow reuse of socket.
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -89,7 +142,15 @@ class SearchServer:
             connection, client_addr = server_socket.accept()
             connection.settimeout(5.0)
             print("Client from %s: %d" % client_addr)
+            threading.Thread(target=self.handle_client, args=(connection,),
+                             daemon=True).start()
 
+    def handle_client(self, connection):
+        """
+        Read a request from the client connected via the given socket,
+        send the response and close the connection.
+        """
+        try:
             # Read request from client. Read in rounds untill a '\r\n\r\n' sequence.
             request = self.read_request(connection)
 
@@ -127,8 +188,7 @@ class SearchServer:
                 except KeyError:
                     pass
                 if requested_file == "search.html" and query:
-                    search_results = self.answer_query(query[2:])
-                    response_bytes = json.dumps(search_results).encode('utf-8')
+                    response_bytes = self.answer_query_json(query[2:])
                     content_type = media_types["json"]
 #                    search_results = [f"{e['name']}; {e['desc']}; {e['url']}"\
 #                            for e in self.answer_query(query[2:])]
@@ -146,8 +206,9 @@ class SearchServer:
                       (status, status_codes[status], content_length, content_type)
             connection.sendall(headers.encode('utf-8'))
             connection.sendall(response_bytes)
-
-            # Close the connection when the conversation finishes.
+        finally:
+            # Close the connection when the conversation finishes, also if
+            # answering the request failed.
             connection.close()
 
 